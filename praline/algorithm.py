@@ -9,6 +9,9 @@ import sys
 import math
 
 import rad_ut as ru
+import profiler
+import memo
+import quadtree
 from constants import M_PROTON_G, ESU, C, V_PER_E
 
 from re import match
@@ -84,6 +87,12 @@ def D(i, j, y):
                                 ru.bc_enforce_N(y, i - 1, j) +
                                 ru.bc_enforce_N(y, i, j + 1) +
                                 ru.bc_enforce_N(y, i, j - 1))
+    # The Dirichlet ghost bins outside the grid hold -x[i, j] (see bc_enforce_D),
+    # so their terms belong on the diagonal rather than in O. Keeping them in O
+    # makes over-relaxed sweeps unstable at the edges.
+    ghosts = ((i == 0) + (i == y.shape[0] - 1) +
+              (j == 0) + (j == y.shape[1] - 1))
+    d -= ghosts * y[i, j]
 
     return d
 
@@ -92,15 +101,50 @@ def O(i, j, x, y):
     '''
     Supplemental function used during Gauss-Seidel Iteration
     '''
-    a = 0.5 * (ru.bc_enforce_D(x, i + 1, j) * (ru.bc_enforce_N(y, i + 1, j) + y[i, j]) +
-               ru.bc_enforce_D(x, i - 1, j) * (ru.bc_enforce_N(y, i - 1, j) + y[i, j]) +
-               ru.bc_enforce_D(x, i, j + 1) * (ru.bc_enforce_N(y, i, j + 1) + y[i, j]) +
-               ru.bc_enforce_D(x, i, j - 1) * (ru.bc_enforce_N(y, i, j - 1) + y[i, j]))
+    a = 0.5 * (ru.bc_enforce_Z(x, i + 1, j) * (ru.bc_enforce_N(y, i + 1, j) + y[i, j]) +
+               ru.bc_enforce_Z(x, i - 1, j) * (ru.bc_enforce_N(y, i - 1, j) + y[i, j]) +
+               ru.bc_enforce_Z(x, i, j + 1) * (ru.bc_enforce_N(y, i, j + 1) + y[i, j]) +
+               ru.bc_enforce_Z(x, i, j - 1) * (ru.bc_enforce_N(y, i, j - 1) + y[i, j]))
 
     return a
 
 
-def B_recon(flux, flux_ref, Bperp, s2r_cm, s2d_cm, bin_um, Ep_MeV, tol_iter, max_iter):
+def stencil(y):
+    '''
+    Array form of D and O, used by the threaded Gauss-Seidel sweeps
+
+    Parameters
+    ----------
+    y (2D array): exp(fluence contrast)
+
+    Returns
+    -------
+    coef (tuple of 2D arrays): The diagonal, D, and the coefficients of the
+                               (i+1,j), (i-1,j), (i,j+1) and (i,j-1) neighbours in O
+    '''
+    yp = np.pad(y, 1, mode='edge')  # Same as bc_enforce_N
+    c = yp[1:-1, 1:-1]
+    cxp = 0.5 * (yp[2:, 1:-1] + c)
+    cxm = 0.5 * (yp[:-2, 1:-1] + c)
+    cyp = 0.5 * (yp[1:-1, 2:] + c)
+    cym = 0.5 * (yp[1:-1, :-2] + c)
+    d = -(cxp + cxm + cyp + cym)
+    # Dirichlet ghost bins are on the diagonal, as in D
+    d[0, :] -= c[0, :]
+    d[-1, :] -= c[-1, :]
+    d[:, 0] -= c[:, 0]
+    d[:, -1] -= c[:, -1]
+    cxp[-1, :] = 0.0
+    cxm[0, :] = 0.0
+    cyp[:, -1] = 0.0
+    cym[:, 0] = 0.0
+
+    return (d, cxp, cxm, cyp, cym)
+
+
+def B_recon(flux, flux_ref, Bperp, s2r_cm, s2d_cm, bin_um, Ep_MeV, tol_iter, max_iter,
+            prof=None, omega=1.0, chebyshev=False, threads=0, cache=None,
+            adaptive=False, adapt_tol=0.01, adapt_nsigma=2.0):
     '''
     Produces a reconstructed magnetic field
 
@@ -112,45 +156,129 @@ def B_recon(flux, flux_ref, Bperp, s2r_cm, s2d_cm, bin_um, Ep_MeV, tol_iter, max
     s2d_cm (float): Distance from the proton source to the interaction region, in cm
     bin_um (float): Length of the side of a bin, in cm
     Ep_MeV (float): Kinetic Energy
+    prof (Profiler): if given, each stage of the reconstruction is measured
+    omega (float or 'auto'): Over-relaxation of the Gauss-Seidel sweeps, 'auto' estimates it
+    chebyshev (bool): if True use Chebyshev accelerated red/black sweeps instead
+    threads (int): if > 0, run red/black sweeps of the array form of D and O
+                   on this many threads
+    cache (StageCache): if given, Src and Lam, the initial phi and the converged
+                        phi are memoized. A cached phi that does not meet
+                        tol_iter is iterated further rather than started over.
+    adaptive (bool): if True solve directly on a quadtree of bins (see quadtree.build)
+                     instead of iterating on the uniform grid
+    adapt_tol (float): Largest difference of the fluence contrast within a quadtree leaf
+    adapt_nsigma (float): Number of standard deviations of the counting noise
+                          of the fluence contrast allowed within a quadtree leaf
 
     Returns
     -------
     BperpR (2D array of (x,y)): Reconstructed Magnetic Field
     BperpS (2D array of (x,y)): True Magnetic Field
+    phi (2D array): Converged solution of the diffusion equation, times the bin area
+    Lam (2D array): fluence contrast
+    GS (tuple): L2 norm of the residual and the number of Gauss-Seidel iterations,
+                zero in adaptive mode
     '''
+    if prof is None:
+        prof = profiler.Profiler(enabled=False)
     ru.delta = bin_um / 10000.0
 
     num_bins = flux_ref.shape[0]  # num_bins x num_bins
+    if cache is None:
+        cache = memo.StageCache(maxsize=0)
     # RHS of the Steady-State Diffusion Equation and Fluence Contrast
-    Src, Lam = steady_state(flux, flux_ref)
-    # The real component after Lam is transformed then convolved and then inversely transformed
-    phi = ru.solve_poisson(Lam)
+    with prof.stage("steady_state"):
+        key = memo.stage_key("steady_state", flux, flux_ref)
+        # Src and Lam are not modified, so they are shared with the cache
+        hit = cache.get(key, copy=False)
+        if hit is None:
+            Src, Lam = steady_state(flux, flux_ref)
+            cache.put(key, {'Src': Src, 'Lam': Lam}, copy=False)
+        else:
+            Src, Lam = hit['Src'], hit['Lam']
+        prof.arrays(Src=Src, Lam=Lam)
+        prof.record(cached=hit is not None)
+    # The real component after Lam is transformed then convolved and then inversely
+    # transformed, the initial phi of the iteration (the quadtree solve needs none)
+    if not adaptive:
+        with prof.stage("solve_poisson"):
+            key_phi0 = memo.stage_key("solve_poisson", key)
+            hit = cache.get(key_phi0)
+            if hit is None:
+                phi = ru.solve_poisson(Lam)
+                cache.put(key_phi0, {'phi': phi})
+            else:
+                phi = hit['phi']
+            prof.arrays(phi=phi)
+            prof.record(cached=hit is not None)
     # Uniform B Field Strength
     Bconst = b_field(s2r_cm, s2d_cm, Ep_MeV)
     # Iterate to solution
-    print ("Gauss-Seidel Iteration...")
-    GS = ru.Gauss_Seidel(phi, np.exp(Lam), D, O, Src,
-                         talk=20, tol=tol_iter, maxiter=max_iter)
+    if adaptive:
+        print ("Quadtree Solve...")
+    else:
+        print ("Gauss-Seidel Iteration...")
+    with prof.stage("solver"):
+        if adaptive:
+            # key hashes flux and flux_ref, which Lam, Src and the leaves depend on
+            key_phi = memo.stage_key("quadtree", key, tol=adapt_tol, nsigma=adapt_nsigma)
+            hit = cache.get(key_phi)
+            if hit is None:
+                leaves = quadtree.build(Lam, flux, tol=adapt_tol, nsigma=adapt_nsigma)
+                phi, res = quadtree.solve(Lam, Src, leaves)
+                GS = (res, 0)
+                unknowns = len(leaves)
+                cache.put(key_phi, {'phi': phi, 'residual': res, 'unknowns': unknowns})
+            else:
+                phi = hit['phi']
+                GS = (hit['residual'], 0)
+                unknowns = hit['unknowns']
+            print ("Adaptive grid: %d unknowns instead of %d" % (unknowns, Lam.size))
+            prof.arrays(phi=phi)
+            prof.record(residual=GS[0], unknowns=unknowns, cached=hit is not None)
+        else:
+            # The tolerance and number of iterations are not part of the key, so a
+            # run with a tighter tolerance resumes from the cached solution
+            key_phi = memo.stage_key("solver", key_phi0, omega=omega, chebyshev=chebyshev)
+            hit = cache.get(key_phi)
+            done = 0
+            if hit is not None:
+                phi = hit['phi']
+                GS = (hit['residual'], hit['iterations'])
+                done = GS[1] + 1
+                print ("Cached solution found, L2 of residual = %10.3E" % GS[0])
+            if hit is None or (GS[0] > tol_iter and done < max_iter):
+                ExpLam = np.exp(Lam)
+                GS = ru.Gauss_Seidel(phi, ExpLam, D, O, Src,
+                                     talk=20, tol=tol_iter, maxiter=max_iter - done,
+                                     omega=omega, chebyshev=chebyshev,
+                                     threads=threads, stencil=stencil)
+                GS = (GS[0], GS[1] + done)
+                cache.put(key_phi, {'phi': phi, 'residual': GS[0], 'iterations': GS[1]})
+                prof.arrays(ExpLam=ExpLam)
+            prof.record(residual=GS[0], iterations=GS[1], cached=hit is not None)
     # Multiplying by the area of the bin
     phi *= (ru.delta**2)
-    # Reconstructed perpendicular B Fields
-    BperpR = np.zeros((num_bins, num_bins, 2))
-    # True perpendicular B Fields
-    BperpS = np.zeros((num_bins, num_bins, 2))
-    # Reconstructed Lateral motion of proton
-    deltaXR = np.zeros((num_bins, num_bins, 2))
+    with prof.stage("gradient"):
+        # Reconstructed perpendicular B Fields
+        BperpR = np.zeros((num_bins, num_bins, 2))
+        # True perpendicular B Fields
+        BperpS = np.zeros((num_bins, num_bins, 2))
+        # Reconstructed Lateral motion of proton
+        deltaXR = np.zeros((num_bins, num_bins, 2))
 
-    for i in range(num_bins):
-        for j in range(num_bins):
-            # Reconstructed Data
-            deltaXR[i, j] = -ru.gradient(phi, (i, j))
-            BperpR[i, j, 0] = Bconst * deltaXR[i, j, 1]
-            BperpR[i, j, 1] = -Bconst * deltaXR[i, j, 0]
-            # True Data
-            # x = ru.idx2vec((i, j))
-            # x = x + deltaXR[i, j]
-            # idx = ru.vec2idx(x)
-            # BperpS[i, j, :] = Bperp[idx[0] % num_bins, idx[1] % num_bins, :]
+        for i in range(num_bins):
+            for j in range(num_bins):
+                # Reconstructed Data
+                deltaXR[i, j] = -ru.gradient(phi, (i, j))
+                BperpR[i, j, 0] = Bconst * deltaXR[i, j, 1]
+                BperpR[i, j, 1] = -Bconst * deltaXR[i, j, 0]
+                # True Data
+                # x = ru.idx2vec((i, j))
+                # x = x + deltaXR[i, j]
+                # idx = ru.vec2idx(x)
+                # BperpS[i, j, :] = Bperp[idx[0] % num_bins, idx[1] % num_bins, :]
+        prof.arrays(BperpR=BperpR, BperpS=BperpS, deltaXR=deltaXR)
 
     print ("#L2 norm of residual = %12.5E ;  Number of Gauss-Seidel iterations = %d\n" % GS)
-    return BperpR, BperpS
+    return BperpR, BperpS, phi, Lam, GS
@@ -12,6 +12,9 @@ import Bplot2 as plot
 import image
 import path
 import rad_ut as ru
+import output
+import profiler
+import stats
 
 import numpy as np
 import pandas as pd
@@ -27,7 +30,20 @@ def get_input_data():
         parser.add_argument("-v", "--verbose", help="increase output verbosity",
                             action="store_true")
         parser.add_argument("input_file", type=str,
-                            help="The filename including the path")
+                            help="The filename including the path, or a .npz archive "
+                            "written by --output, which is memory-mapped if it is uncompressed")
+        parser.add_argument("--no-plot", dest="plot", action="store_false",
+                            help="Skip the plots, so that images larger than RAM can be analyzed")
+        parser.add_argument("--output", default=None, type=str,
+                            help="Write Lam, flux and the run metadata to this .npz archive")
+        parser.add_argument("--float32", action="store_true",
+                            help="Store the output arrays as float32")
+        parser.add_argument("--no-compress", dest="compress", action="store_false",
+                            help="Store the output arrays uncompressed so they can be memory-mapped")
+        parser.add_argument("--profile", default=None, type=str,
+                            help="Write a JSON report of the time and memory of each stage to this file")
+        parser.add_argument("--cprofile", default=None, type=str,
+                            help="With --profile, also dump cProfile statistics of the statistics to this file")
         #TODO: Implement masking tool
         # parser.add_argument("--x1", default=0, type=int,
         #                     help="the first percentage of the x interval e.g 10 percent DEFAULT:0")
@@ -39,6 +55,8 @@ def get_input_data():
         #                     help="the latter percentage of the y interval e.g 30 percent. DEFAULT:0")
 
         args = parser.parse_args()
+        if args.cprofile is not None and args.profile is None:
+            parser.error("--cprofile requires --profile")
 
         return args
 
@@ -53,11 +71,17 @@ def prad_wrap():
     filename(required): including path
     rtype(required): carlo, mitcsv, flash4
     bin_um(required): length of the bin in microns
+    no-plot(option): Skip the flux and fluence contrast plots
+    output(option): .npz archive for the analyzed arrays
+    float32(option): Store the output arrays as float32
+    no-compress(option): Store the output arrays uncompressed
+    profile(option): JSON report of the time and memory of each stage
+    cprofile(option): cProfile statistics of the statistics stage
 
     Returns
     -------
     files (string): flux and fluence contrast plots and other various plots if
-    path integrated data is available.
+    path integrated data is available, and optionally a .npz archive of the arrays
     '''
     print "STARTING ANALYSIS AND PLOTTING..."
     # First Parameter: Path name of the file
@@ -65,32 +89,79 @@ def prad_wrap():
     # Input variables and options
     args = get_input_data()
     fn = args.input_file
-    pr = reader.loadPRRp(fn)
-    rtype = pr.rtype
-    flux = pr.flux2D
-    flux_ref = pr.flux2D_ref
-    sr2_cm = pr.s2r_cm
-    s2d_cm = pr.s2d_cm
-    Ep_MeV = pr.Ep_MeV
-    bin_um = pr.bin_um
-    flux = flux.T
-    flux_ref = flux_ref.T
+    prof = profiler.Profiler(enabled=args.profile is not None, cprofile=args.cprofile,
+                             hot=('statistics',))
+    with prof.stage("load"):
+        if fn.endswith('.npz'):
+            # Arrays from an earlier run, already in (x,y) order
+            arrays, info = output.load_output(fn)
+            flux = arrays['flux']
+            flux_ref = arrays['flux_ref']
+            fluc = arrays.get('Lam')
+        else:
+            pr = reader.loadPRRp(fn)
+            info = {'rtype': pr.rtype, 's2r_cm': pr.s2r_cm, 's2d_cm': pr.s2d_cm,
+                    'Ep_MeV': pr.Ep_MeV, 'bin_um': pr.bin_um}
+            flux = pr.flux2D.T
+            flux_ref = pr.flux2D_ref.T
+            fluc = None
+        prof.arrays(flux=flux, flux_ref=flux_ref)
+    rtype = info['rtype']
+    sr2_cm = info['s2r_cm']
+    s2d_cm = info['s2d_cm']
+    Ep_MeV = info['Ep_MeV']
+    bin_um = info['bin_um']
     print("\n")
 
     flux_min =10.0
     # Protons per bin 2D Histogram
-    image.hist2D_plot(flux, bin_um, rtype,"Flux")
-    print "Mean counts per bin: %12.5E ; Std. Dev. Counts per bin: %12.5E" % (flux.mean(), flux.std())
-    print "Max counts per bin: %d ; Min counts per bin: %d" % (flux.max(), flux.min())
-    print "Number of bins with zero protons: %d" % (flux.size - flux[ flux>0 ].size)
-    print "Number of bins with %d or fewer protons: %d\n" % (flux_min, flux.size - flux[ flux>flux_min ].size)
+    if args.plot:
+        with prof.stage("plot_flux"):
+            image.hist2D_plot(flux, bin_um, rtype,"Flux")
 
     # Fluence Distrubtion of protons at the screen 2D Histogram
-    Src, fluc = alog.steady_state(flux, flux_ref)
-    image.hist2D_plot(fluc, bin_um, rtype, "Fluence")
-    Flpos = fluc[flux >= flux_min]
-    print "Mean Fluct.: %12.5E ; Std. Dev. Fluct.: %12.5E" % (Flpos.mean(), Flpos.std())
-    print "Max Fluct: %12.5E ; Min Fluct: %12.5E" % (Flpos.max(), Flpos.min())
+    if fluc is None and args.plot:
+        with prof.stage("steady_state"):
+            Src, fluc = alog.steady_state(flux, flux_ref)
+            prof.arrays(Src=Src, Lam=fluc)
+
+    # All the statistics in one pass; the fluence contrast is calculated a
+    # block at a time if it has not been already
+    with prof.stage("statistics"):
+        st = stats.image_stats(flux, flux_ref, fluc, flux_min)
+    fs = st['flux']
+    print "Mean counts per bin: %12.5E ; Std. Dev. Counts per bin: %12.5E" % (fs['mean'], fs['std'])
+    print "Max counts per bin: %d ; Min counts per bin: %d" % (fs['max'], fs['min'])
+    print "Number of bins with zero protons: %d" % fs['zero']
+    print "Number of bins with %d or fewer protons: %d" % (flux_min, fs['low'])
+    print "Percentiles of counts per bin: " + \
+        " ; ".join("%d%%: %12.5E" % (q, v) for q, v in sorted(fs['percentiles'].items())) + "\n"
+
+    if args.plot:
+        with prof.stage("plot_fluence"):
+            image.hist2D_plot(fluc, bin_um, rtype, "Fluence")
+    ls = st['fluc']
+    print "Mean Fluct.: %12.5E ; Std. Dev. Fluct.: %12.5E" % (ls['mean'], ls['std'])
+    print "Max Fluct: %12.5E ; Min Fluct: %12.5E" % (ls['max'], ls['min'])
+    print "Percentiles of Fluct.: " + \
+        " ; ".join("%d%%: %12.5E" % (q, v) for q, v in sorted(ls['percentiles'].items()))
+
+    meta = {'input_file': fn, 'rtype': rtype, 's2r_cm': sr2_cm,
+            's2d_cm': s2d_cm, 'Ep_MeV': Ep_MeV, 'bin_um': bin_um,
+            'num_bins': flux.shape[0]}
+    if args.output is not None:
+        if fluc is None:
+            # Calculated a chunk at a time as it is written
+            fluc = stats.ContrastRows(flux, flux_ref)
+        arrays = {'Lam': fluc, 'flux': flux, 'flux_ref': flux_ref,
+                  'flux_hist': fs['hist'], 'flux_edges': fs['edges'],
+                  'Lam_hist': ls['hist'], 'Lam_edges': ls['edges']}
+        with prof.stage("output"):
+            output.save_output(args.output, arrays, meta,
+                               float32=args.float32, compress=args.compress)
+
+    if args.profile is not None:
+        prof.report(args.profile, meta)
 
 if __name__=="__main__":
     prad_wrap()
@@ -0,0 +1,273 @@
+'''
+Runs reconstructions in a long-running local daemon, so that interpreter startup,
+imports and Poisson kernel setup are paid once rather than for every radiograph.
+
+Jobs are submitted over a UNIX socket as one line of JSON holding the
+lin-reconstruct arguments and the working directory of the client. The daemon
+streams back one line of JSON per line of progress output, followed by the result.
+'''
+import sys
+import os
+import json
+import socket
+import threading
+import multiprocessing
+import argparse as ap
+
+try:
+    import socketserver
+    from queue import Empty
+except ImportError:
+    import SocketServer as socketserver
+    from Queue import Empty
+
+import rad_ut as ru
+import reconstruct
+
+# Seconds between checks that the worker running a job is still alive
+POLL_S = 1.0
+
+# Number of checks a job may stay unstarted while a worker is idle before it is
+# reported as lost, i.e. its worker died before the job could say it started
+LOST_POLLS = 5
+
+
+def get_input_data():
+    '''
+    Command line options and variables
+    '''
+    parser = ap.ArgumentParser(
+        description="This script runs a daemon that reconstructs the magnetic field of "
+        "Proton Radiography experiments submitted with lin-reconstruct --socket")
+    parser.add_argument("socket", type=str,
+                        help="The UNIX socket to listen on")
+    parser.add_argument("--workers", default=multiprocessing.cpu_count(), type=int,
+                        help="The number of worker processes. DEFAULT: number of CPUs")
+    parser.add_argument("--warm", default="", type=str,
+                        help="Comma separated number of bins per side to prepare Poisson "
+                        "kernels for, e.g. 128,256. DEFAULT: none")
+    args = parser.parse_args()
+
+    return args
+
+
+class _QueueWriter(object):
+    '''
+    File-like object that sends each line printed by a job to the client
+    '''
+    def __init__(self, queue):
+        self.queue = queue
+        self.buf = ''
+
+    def write(self, text):
+        self.buf += text
+        while '\n' in self.buf:
+            line, self.buf = self.buf.split('\n', 1)
+            self.queue.put({'type': 'progress', 'line': line})
+
+    def flush(self):
+        if self.buf:
+            self.queue.put({'type': 'progress', 'line': self.buf})
+            self.buf = ''
+
+
+def _warm(shapes):
+    '''
+    Worker initializer: calculates the Poisson kernels of the given grid sizes
+    '''
+    for num_bins in shapes:
+        ru.poisson_kernel((num_bins, num_bins))
+
+
+def _run_job(job, queue):
+    '''
+    Runs a single reconstruction job in a worker process
+    '''
+    queue.put({'type': 'started', 'pid': os.getpid()})
+    stdout = sys.stdout
+    sys.stdout = _QueueWriter(queue)
+    try:
+        os.chdir(job['cwd'])
+        args = reconstruct.get_input_data(job['argv'])
+        meta = reconstruct.run(args)
+        sys.stdout.flush()
+        queue.put({'type': 'result', 'status': 'done', 'meta': meta})
+    except BaseException as e:
+        sys.stdout.flush()
+        queue.put({'type': 'result', 'status': 'error',
+                   'error': '%s: %s' % (type(e).__name__, e)})
+    finally:
+        sys.stdout = stdout
+
+
+def _lost(pending, pid, queue):
+    '''
+    Checks a job whose queue is empty. Returns the next message if the job has
+    finished, an error result if it can no longer send one, or None if it is
+    still queued or running.
+    '''
+    if pending.ready():
+        # The result is put before _run_job returns, so it is in the queue
+        # unless the job failed outside of _run_job
+        try:
+            return queue.get(timeout=POLL_S)
+        except Empty:
+            try:
+                pending.get(0)
+                error = 'The job ended without a result'
+            except Exception as e:
+                error = '%s: %s' % (type(e).__name__, e)
+            return {'type': 'result', 'status': 'error', 'error': error}
+    # A pool replaces a worker that dies, but never finishes its job
+    if pid is not None and pid not in [p.pid for p in multiprocessing.active_children()]:
+        return {'type': 'result', 'status': 'error',
+                'error': 'The worker running the job (pid %d) died' % pid}
+    return None
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    '''
+    Handles one client connection: submits its job to the pool and streams
+    the progress and the result back
+    '''
+    def send(self, msg):
+        self.wfile.write((json.dumps(msg) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        job = json.loads(self.rfile.readline().decode('utf-8'))
+        queue = self.server.manager.Queue()
+        pending = self.server.pool.apply_async(_run_job, (job, queue))
+        pid = None
+        idle = 0
+        try:
+            while True:
+                try:
+                    msg = queue.get(timeout=POLL_S)
+                except Empty:
+                    msg = _lost(pending, pid, queue)
+                    if msg is None and pid is None:
+                        # A queued job is taken as soon as a worker is free
+                        idle = idle + 1 if self.server.idle() else 0
+                        if idle >= LOST_POLLS:
+                            msg = {'type': 'result', 'status': 'error',
+                                   'error': 'The job was lost before it started, '
+                                   'its worker probably died'}
+                    if msg is None:
+                        continue
+                if msg['type'] == 'started':
+                    pid = msg['pid']
+                    with self.server.lock:
+                        self.server.running.add(pid)
+                    continue
+                try:
+                    self.send(msg)
+                except socket.error:
+                    # The client went away, the job still runs to completion
+                    pass
+                if msg['type'] == 'result':
+                    break
+        finally:
+            with self.server.lock:
+                self.server.running.discard(pid)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def idle(self):
+        '''
+        Returns True if fewer jobs are running than there are workers
+        '''
+        with self.lock:
+            return len(self.running) < self.workers
+
+
+def serve(socket_path, workers, shapes=()):
+    '''
+    Listens on a UNIX socket and runs the submitted jobs on a pool of warm workers
+
+    Parameters
+    ----------
+    socket_path (string): The UNIX socket to listen on
+    workers (int): The number of worker processes
+    shapes (list of ints): Number of bins per side to prepare Poisson kernels for
+    '''
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    manager = multiprocessing.Manager()
+    pool = multiprocessing.Pool(workers, initializer=_warm, initargs=(list(shapes),))
+    server = _Server(socket_path, _JobHandler)
+    server.manager = manager
+    server.pool = pool
+    server.workers = workers
+    # Worker pids of the jobs that have started and not yet sent their result
+    server.running = set()
+    server.lock = threading.Lock()
+    print ("Listening on %s with %d workers" % (socket_path, workers))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.terminate()
+        manager.shutdown()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def submit(socket_path, argv, talk=True):
+    '''
+    Submits a lin-reconstruct job to the daemon and waits for the result
+
+    Parameters
+    ----------
+    socket_path (string): The UNIX socket the daemon is listening on
+    argv (list of strings): lin-reconstruct arguments, relative paths are
+                            relative to the current directory
+    talk (bool): if True the progress of the job is printed
+
+    Returns
+    -------
+    result (dict): status ('done' or 'error'), and the run metadata or the error
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    fd = sock.makefile('rwb')
+    job = {'argv': list(argv), 'cwd': os.getcwd()}
+    fd.write((json.dumps(job) + '\n').encode('utf-8'))
+    fd.flush()
+
+    result = {'status': 'error', 'error': 'Connection to the daemon was lost'}
+    for line in fd:
+        msg = json.loads(line.decode('utf-8'))
+        if msg['type'] == 'progress':
+            if talk:
+                print (msg['line'])
+        else:
+            result = msg
+            break
+    fd.close()
+    sock.close()
+
+    if result['status'] != 'done':
+        print ("Reconstruction failed: " + result['error'])
+    return result
+
+
+def daemon_wrap():
+    '''
+    Wrapper Function for Command line tool that starts the reconstruction daemon
+
+    Parameters
+    ----------
+    socket(required): The UNIX socket to listen on
+    workers(option): The number of worker processes
+    warm(option): Number of bins per side to prepare Poisson kernels for
+    '''
+    args = get_input_data()
+    shapes = [int(n) for n in args.warm.split(',') if n]
+    serve(args.socket, args.workers, shapes)
+
+
+if __name__ == "__main__":
+    daemon_wrap()
@@ -0,0 +1,161 @@
+'''
+Provides memoization of the stages of the reconstruction, so that changing only
+downstream options (e.g. the tolerance) does not recompute the upstream stages
+'''
+import os
+import hashlib
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+def stage_key(stage, *inputs, **params):
+    '''
+    Hashes the inputs and parameters of a stage
+
+    Parameters
+    ----------
+    stage (string): Name of the stage
+    inputs (arrays or strings): Input arrays, or the keys of upstream stages
+    params: Parameters of the stage
+
+    Returns
+    -------
+    key (string): Hex digest identifying the result of the stage
+    '''
+    h = hashlib.sha1(stage.encode('utf-8'))
+    for item in inputs:
+        if isinstance(item, np.ndarray):
+            item = np.ascontiguousarray(item)
+            h.update(repr((item.dtype.str, item.shape)).encode('utf-8'))
+            h.update(item.view(np.uint8).data)
+        else:
+            h.update(repr(item).encode('utf-8'))
+    h.update(repr(sorted(params.items())).encode('utf-8'))
+    return h.hexdigest()
+
+
+class StageCache(object):
+    '''
+    Least recently used cache of stage results, kept in memory and optionally
+    in a directory on disk. Results are dicts of arrays and numbers. Results
+    kept in memory are copied when stored and returned unless the caller
+    passes copy=False, promising not to modify them.
+
+    Parameters
+    ----------
+    maxsize (int): Number of results kept in memory, 0 keeps none
+    cache_dir (string): if given, results are also written to this directory
+    maxdisk (int): Number of results kept in cache_dir, the least recently
+                   used are deleted
+    '''
+    def __init__(self, maxsize=0, cache_dir=None, maxdisk=32):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.maxdisk = maxdisk
+        self.mem = OrderedDict()
+        if cache_dir is not None:
+            _makedirs(cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _remember(self, key, value):
+        self.mem.pop(key, None)
+        if self.maxsize > 0:
+            self.mem[key] = value
+        self.trim()
+
+    def trim(self):
+        '''
+        Drops the least recently used results until at most maxsize are in memory
+        '''
+        while len(self.mem) > max(self.maxsize, 0):
+            self.mem.popitem(last=False)
+
+    def get(self, key, copy=True):
+        '''
+        Returns the result stored under key, or None
+        '''
+        if key in self.mem:
+            value = self.mem.pop(key)
+            self.mem[key] = value
+        elif self.cache_dir is not None and os.path.exists(self._path(key)):
+            try:
+                with np.load(self._path(key)) as fd:
+                    value = dict((name, fd[name] if fd[name].ndim else fd[name].item())
+                                 for name in fd.files)
+                # Mark as recently used
+                os.utime(self._path(key), None)
+            except (IOError, OSError, ValueError, zipfile.BadZipfile):
+                # Evicted by another process after the check, a miss
+                return None
+            self._remember(key, value)
+            if key not in self.mem:
+                # Freshly loaded, so the caller may have it without a copy
+                return value
+        else:
+            return None
+
+        return _copy(value) if copy else value
+
+    def put(self, key, value, copy=True):
+        '''
+        Stores a result under key
+        '''
+        if self.maxsize > 0:
+            self._remember(key, _copy(value) if copy else value)
+        if self.cache_dir is None:
+            return
+        # The directory may have been removed since the cache was made
+        _makedirs(self.cache_dir)
+        # Write then rename, so other processes never read a partial file
+        tmp = os.path.join(self.cache_dir, '%s.%d.tmp.npz' % (key, os.getpid()))
+        np.savez(tmp, **value)
+        os.rename(tmp, self._path(key))
+        files = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                 if f.endswith('.npz') and not f.endswith('.tmp.npz')]
+        files.sort(key=os.path.getmtime)
+        for f in files[:max(0, len(files) - self.maxdisk)]:
+            try:
+                os.remove(f)
+            except OSError:
+                # Already evicted by another process
+                pass
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        # Made by another process in the meantime
+        if not os.path.isdir(path):
+            raise
+
+
+def _copy(value):
+    return dict((name, np.copy(v) if isinstance(v, np.ndarray) else v)
+                for name, v in value.items())
+
+
+# Cache shared by the reconstructions run in this process
+_caches = {}
+
+def get_cache(cache_dir=None, maxdisk=32, maxsize=0):
+    '''
+    Returns the StageCache of this process for a cache directory, keeping at
+    most maxsize results in memory and maxdisk results in cache_dir
+    '''
+    # A lin-daemon worker runs jobs from several directories, so a relative
+    # cache_dir is resolved against the directory of the job
+    if cache_dir is not None:
+        cache_dir = os.path.abspath(cache_dir)
+    if cache_dir not in _caches:
+        _caches[cache_dir] = StageCache(maxsize=maxsize, cache_dir=cache_dir,
+                                        maxdisk=maxdisk)
+    cache = _caches[cache_dir]
+    cache.maxdisk = maxdisk
+    cache.maxsize = maxsize
+    cache.trim()
+    return cache
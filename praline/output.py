@@ -0,0 +1,169 @@
+'''
+Provides functions that write the arrays computed by the command line tools to a
+chunked, compressed numerical archive and load them back for later analysis
+'''
+import os
+import json
+import struct
+import tempfile
+import zipfile
+
+import numpy as np
+
+# Number of rows written to (or converted for) the archive at a time
+CHUNK_ROWS = 256
+
+# Extension used for every array member of the archive, as with np.savez
+_NPY = '.npy'
+_META = 'meta.json'
+
+
+def _json_scalar(obj):
+    '''
+    Converts numpy scalars in the run metadata to python numbers
+    '''
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+def _write_array(zf, name, array, dtype, compress, chunk_rows):
+    '''
+    Streams a single array into the archive as a .npy member, chunk_rows rows at a time
+
+    Parameters
+    ----------
+    zf (ZipFile): Archive opened for writing
+    name (string): Name of the array in the archive
+    array (ND array): Array to write, may be a memory-mapped array or
+                      any object with shape and dtype whose rows can be sliced
+    dtype (numpy dtype): The dtype the array is stored as
+    compress (bool): if True the member is deflated, otherwise it is stored
+                     so that it can be memory-mapped when loaded
+    chunk_rows (int): Number of rows converted and written at a time
+    '''
+    header = {'descr': np.lib.format.dtype_to_descr(dtype),
+              'fortran_order': False,
+              'shape': array.shape}
+    compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    # The member is streamed to a temporary .npy file next to the archive and
+    # then added to it, since writing to a member needs python 3.6 or later
+    handle, tmp = tempfile.mkstemp(suffix=_NPY,
+                                   dir=os.path.dirname(os.path.abspath(zf.filename)))
+    try:
+        with os.fdopen(handle, 'wb') as fd:
+            np.lib.format.write_array_header_2_0(fd, header)
+            if array.ndim == 0:
+                fd.write(np.asarray(array, dtype=dtype).tobytes())
+            else:
+                for row in range(0, array.shape[0], chunk_rows):
+                    chunk = np.ascontiguousarray(array[row:row + chunk_rows], dtype=dtype)
+                    fd.write(chunk.tobytes())
+        zf.write(tmp, name + _NPY, compress_type=compress_type)
+    finally:
+        os.remove(tmp)
+
+
+def save_output(fname, arrays, meta, float32=False, compress=True, chunk_rows=CHUNK_ROWS):
+    '''
+    Writes the arrays and run metadata to a zipped .npz archive
+
+    The archive can be read by np.load like any other .npz file. Floating point
+    arrays are optionally downcast to float32 one chunk at a time, so a full
+    size copy is never made.
+
+    Parameters
+    ----------
+    fname (string): Name of the archive, including path
+    arrays (dict): Mapping of array name to array, e.g. BperpR, phi, Lam, flux, or to
+                   an object with shape and dtype whose rows can be sliced
+    meta (dict): Run metadata, must be JSON serializable
+    float32 (bool): if True floating point arrays are stored as float32
+    compress (bool): if True each array is deflated, otherwise they are stored
+                     uncompressed so load_output can memory-map them
+    chunk_rows (int): Number of rows written at a time
+
+    Returns
+    -------
+    fname (string): Name of the archive that was written
+    '''
+    print ("Writing output arrays to " + fname)
+    with zipfile.ZipFile(fname, 'w', allowZip64=True) as zf:
+        for name in sorted(arrays):
+            array = arrays[name]
+            if not hasattr(array, 'shape'):
+                array = np.asarray(array)
+            dtype = array.dtype
+            if float32 and np.issubdtype(dtype, np.floating):
+                dtype = np.dtype(np.float32)
+            _write_array(zf, name, array, dtype, compress, chunk_rows)
+        zf.writestr(_META, json.dumps(meta, sort_keys=True, indent=1,
+                                      default=_json_scalar))
+
+    return fname
+
+
+def _member_offset(fd, info):
+    '''
+    Returns the offset in the archive of the first byte of a member's data
+    '''
+    # The local file header is 30 bytes long and is followed by the file name
+    # and an extra field, whose lengths are stored at bytes 26 and 28
+    fd.seek(info.header_offset)
+    local = fd.read(30)
+    name_len, extra_len = struct.unpack('<HH', local[26:30])
+    return info.header_offset + 30 + name_len + extra_len
+
+
+def _memmap_member(fname, fd, info):
+    '''
+    Returns a read only memory-mapped view of an uncompressed .npy member
+    '''
+    fd.seek(_member_offset(fd, info))
+    version = np.lib.format.read_magic(fd)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fd)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fd)
+    order = 'F' if fortran_order else 'C'
+    if len(shape) == 0:
+        return np.fromfile(fd, dtype=dtype, count=1).reshape(shape)
+
+    return np.memmap(fname, dtype=dtype, mode='r', offset=fd.tell(),
+                     shape=shape, order=order)
+
+
+def load_output(fname, mmap=True):
+    '''
+    Loads an archive written by save_output
+
+    Parameters
+    ----------
+    fname (string): Name of the archive, including path
+    mmap (bool): if True arrays stored uncompressed are returned as read only
+                 memory-mapped views, so only the rows that are used are read
+                 from disk. Compressed arrays are always read into memory.
+
+    Returns
+    -------
+    arrays (dict): Mapping of array name to array
+    meta (dict): Run metadata
+    '''
+    arrays = {}
+    meta = {}
+    with zipfile.ZipFile(fname, 'r') as zf:
+        with open(fname, 'rb') as fd:
+            for info in zf.infolist():
+                if info.filename == _META:
+                    meta = json.loads(zf.read(_META).decode('utf-8'))
+                    continue
+                if not info.filename.endswith(_NPY):
+                    continue
+                name = info.filename[:-len(_NPY)]
+                if mmap and info.compress_type == zipfile.ZIP_STORED:
+                    arrays[name] = _memmap_member(fname, fd, info)
+                else:
+                    with zf.open(info) as member:
+                        arrays[name] = np.lib.format.read_array(member)
+
+    return arrays, meta
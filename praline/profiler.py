@@ -0,0 +1,160 @@
+'''
+Provides the instrumentation used by the command line tools to time each stage
+of a run and write a machine-readable report
+'''
+import os
+import sys
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+try:
+    from praline import __version__
+except ImportError:
+    __version__ = None
+
+
+def _cpu_time():
+    '''
+    Returns the user + system CPU time of the process, in seconds
+    '''
+    t = os.times()
+    return t[0] + t[1]
+
+
+def _reset_peak_rss():
+    '''
+    Resets the peak resident set size of the process where the OS allows it,
+    so the peak of each stage can be measured. Returns True on success.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss_mb():
+    '''
+    Returns the peak resident set size of the process, in MB
+    '''
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kB elsewhere
+    if sys.platform == 'darwin':
+        return rss / 1024.0**2
+    return rss / 1024.0
+
+
+class Profiler(object):
+    '''
+    Records wall time, CPU time, peak RSS, array allocation sizes and any other
+    values (e.g. iteration counts) for each stage of a run
+
+    Parameters
+    ----------
+    enabled (bool): if False, stages are run without being measured
+    cprofile (string): if given, the stages named in hot are run under cProfile
+                       and the statistics are dumped to this file
+    hot (tuple of strings): Names of the stages profiled by cProfile
+    '''
+    def __init__(self, enabled=True, cprofile=None, hot=('solver',)):
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.hot = hot
+        self.stages = []
+        self.current = None
+        self.peak = 0.0
+        self.prof = cProfile.Profile() if (enabled and cprofile) else None
+        self.start_wall = time.time()
+        self.start_cpu = _cpu_time()
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Context manager that measures the enclosed stage of the run
+        '''
+        if not self.enabled:
+            yield
+            return
+
+        parent = self.current
+        self.current = {'name': name, 'arrays': {}}
+        per_stage_rss = _reset_peak_rss()
+        wall = time.time()
+        cpu = _cpu_time()
+        if self.prof is not None and name in self.hot:
+            self.prof.enable()
+        try:
+            yield
+        finally:
+            if self.prof is not None and name in self.hot:
+                self.prof.disable()
+            # Nested stages reset the peak, so a stage's peak is the largest
+            # of its own measurement and those of the stages it contains
+            peak = max(_peak_rss_mb() or 0.0, self.current.pop('_peak', 0.0))
+            self.current['wall_s'] = time.time() - wall
+            self.current['cpu_s'] = _cpu_time() - cpu
+            self.current['peak_rss_mb'] = peak
+            self.current['peak_rss_per_stage'] = per_stage_rss
+            self.stages.append(self.current)
+            self.peak = max(self.peak, peak)
+            if parent is not None:
+                parent['_peak'] = max(parent.get('_peak', 0.0), peak)
+            self.current = parent
+
+    def record(self, **values):
+        '''
+        Records values, e.g. iterations or residual, for the current stage
+        '''
+        if self.enabled and self.current is not None:
+            self.current.update(values)
+
+    def arrays(self, **arrays):
+        '''
+        Records the size in bytes of arrays allocated by the current stage
+        '''
+        if self.enabled and self.current is not None:
+            for name, array in arrays.items():
+                self.current['arrays'][name] = int(array.nbytes)
+
+    def report(self, fname, meta=None):
+        '''
+        Writes the recorded stages to a JSON report and dumps the cProfile
+        statistics of the hot path, if requested
+
+        Parameters
+        ----------
+        fname (string): Name of the JSON report, including path
+        meta (dict): Run metadata to include in the report
+        '''
+        report = {'version': __version__,
+                  'python': sys.version.split()[0],
+                  'meta': meta or {},
+                  'stages': self.stages,
+                  'total': {'wall_s': time.time() - self.start_wall,
+                            'cpu_s': _cpu_time() - self.start_cpu,
+                            'peak_rss_mb': max(self.peak, _peak_rss_mb() or 0.0)}}
+        with open(fname, 'w') as fd:
+            json.dump(report, fd, indent=1, sort_keys=True, default=str)
+        print ("Profile report written to " + fname)
+
+        if self.prof is not None:
+            self.prof.dump_stats(self.cprofile)
+            print ("cProfile statistics written to " + self.cprofile)
@@ -0,0 +1,273 @@
+'''
+Provides an adaptive reconstruction that solves the steady-state diffusion
+equation on a quadtree of bins. Bins are merged where the fluence contrast is
+nearly uniform, which cuts the number of unknowns, and the solution is
+interpolated back onto the uniform grid of bins.
+'''
+import numpy as np
+from scipy.interpolate import griddata
+from scipy.sparse import coo_matrix, diags
+from scipy.sparse.linalg import spsolve
+
+
+def _summed_area(array):
+    '''
+    Summed area table, so the sum of any block of bins costs four lookups
+    '''
+    sat = np.zeros((array.shape[0] + 1, array.shape[1] + 1))
+    sat[1:, 1:] = array.cumsum(axis=0).cumsum(axis=1)
+    return sat
+
+
+def _block_sum(sat, i0, j0, n0, n1):
+    return sat[i0 + n0, j0 + n1] - sat[i0, j0 + n1] - sat[i0 + n0, j0] + sat[i0, j0]
+
+
+def _children(blocks):
+    '''
+    Splits blocks of bins (rows of i0, j0, n0, n1) in half along each side
+    longer than one bin. Returns the children and the row of their parent.
+    '''
+    i0, j0, n0, n1 = blocks.T
+    s0 = n0 > 1
+    s1 = n1 > 1
+    h0 = np.where(s0, n0 // 2, n0)
+    h1 = np.where(s1, n1 // 2, n1)
+    parent = np.arange(len(blocks))
+    quads = ((s0 | s1, i0, j0, h0, h1),
+             (s0, i0 + h0, j0, n0 - h0, h1),
+             (s1, i0, j0 + h1, h0, n1 - h1),
+             (s0 & s1, i0 + h0, j0 + h1, n0 - h0, n1 - h1))
+    children = np.concatenate([np.column_stack((a[m], b[m], c[m], d[m]))
+                               for m, a, b, c, d in quads])
+    parents = np.concatenate([parent[q[0]] for q in quads])
+    return children, parents
+
+
+def build(Lam, flux=None, tol=0.01, nsigma=2.0, max_size=32):
+    '''
+    Builds the quadtree of bins
+
+    A block of bins is split into (up to) four children if it is larger than
+    max_size bins per side, or if the mean fluence contrast of the children of
+    the block, or of any smaller block inside it, differs by more than
+    tol + nsigma / sqrt(counts), where counts is the smallest number of protons
+    in those children. So bins are merged where the fluence contrast is flat,
+    and kept where its gradients or the number of protons are high.
+
+    Parameters
+    ----------
+    Lam (2D array): fluence contrast
+    flux (2D array): Number of protons per bin. if None, only tol is used.
+    tol (float): Largest significant difference of the children's mean
+                 fluence contrast in a leaf
+    nsigma (float): Number of standard deviations of the counting noise
+                    of the mean fluence contrast that are not significant
+    max_size (int): Largest number of bins per side of a leaf
+
+    Returns
+    -------
+    leaves (2D array): rows of (i0, j0, n0, n1), the first bin and the number
+                       of bins per side of each leaf
+    '''
+    sat = _summed_area(Lam)
+    fsat = _summed_area(flux) if flux is not None else None
+
+    # Every block of the full tree, one level at a time
+    levels = [np.array([[0, 0, Lam.shape[0], Lam.shape[1]]])]
+    parents = []
+    while True:
+        split = (levels[-1][:, 2] > 1) | (levels[-1][:, 3] > 1)
+        if not split.any():
+            break
+        children, parent = _children(levels[-1])
+        levels.append(children)
+        parents.append(parent)
+
+    # From the bottom up: a block needs splitting if its children differ, or
+    # if any of them needs splitting
+    need = np.zeros(0, dtype=bool)
+    needs = [None] * len(levels)
+    for l in range(len(levels) - 1, -1, -1):
+        blocks = levels[l]
+        own = np.maximum(blocks[:, 2], blocks[:, 3]) > max_size
+        if l + 1 < len(levels):
+            children = levels[l + 1]
+            parent = parents[l]
+            i0, j0, n0, n1 = children.T
+            mean = _block_sum(sat, i0, j0, n0, n1) / (n0 * n1)
+            hi = np.full(len(blocks), -np.inf)
+            lo = np.full(len(blocks), np.inf)
+            np.maximum.at(hi, parent, mean)
+            np.minimum.at(lo, parent, mean)
+            limit = np.full(len(blocks), float(tol))
+            if fsat is not None:
+                counts = np.full(len(blocks), np.inf)
+                np.minimum.at(counts, parent, _block_sum(fsat, i0, j0, n0, n1))
+                limit += nsigma / np.sqrt(np.maximum(counts, 1.0))
+            own |= (hi - lo) > limit
+            np.logical_or.at(own, parent, need)
+        need = own
+        needs[l] = need
+
+    # From the top down: the leaves are the first blocks that need no splitting
+    leaves = []
+    active = np.ones(1, dtype=bool)
+    for l in range(len(levels)):
+        leaves.append(levels[l][active & ~needs[l]])
+        if l + 1 < len(levels):
+            active = (active & needs[l])[parents[l]]
+
+    return np.concatenate(leaves)
+
+
+def _gradient(label, ci, cj, nleaf):
+    '''
+    Sparse operators that estimate the gradient of phi in each leaf, along i
+    and along j, from the mean of its neighbours on either side. Where a leaf
+    is on the edge of the grid, its ghost mirrored across the edge (-x, as in
+    bc_enforce_D) is the neighbour on that side.
+    '''
+    N0, N1 = label.shape
+    leaf = np.arange(nleaf)
+    ops = []
+    for a, b, c, n, first, last in (
+            (label[:-1, :], label[1:, :], ci, N0, label[0, :], label[-1, :]),
+            (label[:, :-1], label[:, 1:], cj, N1, label[:, 0], label[:, -1])):
+        face = a != b
+        fa = a[face]
+        fb = b[face]
+        lo_edge = np.zeros(nleaf, dtype=bool)
+        hi_edge = np.zeros(nleaf, dtype=bool)
+        lo_edge[first] = True
+        hi_edge[last] = True
+        # Every bin side counts once, so neighbours that share more of it weigh more
+        rows, cols, vals = [], [], []
+        pos = []
+        for k, nb, edge, ghost in ((fa, fb, hi_edge, 2.0 * n - 1.0 - c),
+                                   (fb, fa, lo_edge, -1.0 - c)):
+            count = np.bincount(k, minlength=nleaf).astype(float)
+            mean_pos = np.bincount(k, c[nb], nleaf)
+            # A leaf either touches the edge or has neighbours on a side
+            count[edge] = 1.0
+            mean_pos[edge] = ghost[edge]
+            rows.append(np.concatenate((k, leaf[edge])))
+            cols.append(np.concatenate((nb, leaf[edge])))
+            vals.append(np.concatenate((1.0 / count[k], -np.ones(edge.sum()))))
+            pos.append(mean_pos / count)
+        hi_avg = coo_matrix((vals[0], (rows[0], cols[0])), shape=(nleaf, nleaf))
+        lo_avg = coo_matrix((vals[1], (rows[1], cols[1])), shape=(nleaf, nleaf))
+        ops.append(diags(1.0 / (pos[0] - pos[1])).dot((hi_avg - lo_avg).tocsr()))
+    return ops
+
+
+def solve(Lam, Src, leaves):
+    '''
+    Solves the steady-state diffusion equation on the leaves of a quadtree with
+    a finite volume discretization, the same as D and O when all leaves are
+    single bins, and interpolates the solution back onto the uniform grid
+
+    Parameters
+    ----------
+    Lam (2D array): fluence contrast
+    Src (2D array): Source term of the Steady-State Diffusion Equation
+    leaves (list of tuples): Leaves returned by build
+
+    Returns
+    -------
+    phi (2D array): Solution on the uniform grid of bins
+    res (float): Relative L2 norm of the residual of the quadtree system
+    '''
+    N0, N1 = Lam.shape
+    y = np.exp(Lam)
+    nleaf = len(leaves)
+    label = np.empty((N0, N1), dtype=int)
+    ci = np.empty(nleaf)
+    cj = np.empty(nleaf)
+    for k, (i0, j0, n0, n1) in enumerate(leaves):
+        label[i0:i0 + n0, j0:j0 + n1] = k
+        ci[k] = i0 + 0.5 * (n0 - 1)
+        cj[k] = j0 + 0.5 * (n1 - 1)
+    grad_i, grad_j = _gradient(label, ci, cj, nleaf)
+    ii, jj = np.indices((N0, N1))
+
+    # Each bin side between two leaves carries the flux of the conductance of
+    # the bin side times the difference of phi over the distance between the
+    # centres of the leaves. Where leaves of different sizes meet, the centres
+    # are offset along the side, so phi of each leaf is first extrapolated along
+    # the side, with its gradient, to the line through the middle of the side.
+    rows, flux = [], []
+    for a, b, ya, yb, c, side, t, grad in (
+            (label[:-1, :], label[1:, :], y[:-1, :], y[1:, :], ci, jj[:-1, :], cj, grad_j),
+            (label[:, :-1], label[:, 1:], y[:, :-1], y[:, 1:], cj, ii[:, :-1], ci, grad_i)):
+        face = a != b
+        fa = a[face]
+        fb = b[face]
+        along = side[face]
+        cond = 0.5 * (ya[face] + yb[face]) / np.abs(c[fa] - c[fb])
+        nface = len(fa)
+        at = np.arange(nface)
+        jump = coo_matrix((np.concatenate((np.ones(nface), -np.ones(nface))),
+                           (np.concatenate((at, at)), np.concatenate((fb, fa)))),
+                          shape=(nface, nleaf))
+        jump = (jump + diags(along - t[fb]).dot(grad[fb]) -
+                diags(along - t[fa]).dot(grad[fa]))
+        flux.append(diags(cond).dot(jump))
+        # The flux leaves a and enters b
+        rows.append(coo_matrix((np.concatenate((np.ones(nface), -np.ones(nface))),
+                                (np.concatenate((fa, fb)), np.concatenate((at, at)))),
+                               shape=(nleaf, nface)))
+
+    # Bin sides on the edge of the grid see phi = 0 half a bin outside the grid
+    for kw, cw, along, t, grad in (
+            (label[0, :], y[0, :] / (ci[label[0, :]] + 0.5), jj[0, :], cj, grad_j),
+            (label[-1, :], y[-1, :] / (N0 - 0.5 - ci[label[-1, :]]), jj[-1, :], cj, grad_j),
+            (label[:, 0], y[:, 0] / (cj[label[:, 0]] + 0.5), ii[:, 0], ci, grad_i),
+            (label[:, -1], y[:, -1] / (N1 - 0.5 - cj[label[:, -1]]), ii[:, -1], ci, grad_i)):
+        nface = len(kw)
+        at = np.arange(nface)
+        value = (coo_matrix((np.ones(nface), (at, kw)), shape=(nface, nleaf)) +
+                 diags(along - t[kw]).dot(grad[kw]))
+        flux.append(diags(-cw).dot(value))
+        rows.append(coo_matrix((np.ones(nface), (kw, at)), shape=(nleaf, nface)))
+
+    A = sum(r.tocsr().dot(f.tocsr()) for r, f in zip(rows, flux)).tocsc()
+    b = np.bincount(label.ravel(), Src.ravel(), nleaf)
+
+    x = spsolve(A, b)
+    res = np.linalg.norm(A.dot(x) - b) / np.linalg.norm(b)
+
+    phi = _interpolate(leaves, x, (N0, N1))
+
+    return phi, res
+
+
+def _interpolate(leaves, x, shape):
+    '''
+    Interpolates values at the leaf centres onto the uniform grid of bins
+    '''
+    # Piecewise cubic (C1) interpolation from the leaf centres, so the gradient,
+    # and the field, are continuous across leaves. Leaves on the edge of the grid
+    # are mirrored across it holding -x, as in bc_enforce_D, so phi = 0 on the edge.
+    N0, N1 = shape
+    i0, j0, n0, n1 = np.asarray(leaves).T
+    ci = i0 + 0.5 * (n0 - 1)
+    cj = j0 + 0.5 * (n1 - 1)
+    lo0 = i0 == 0
+    hi0 = i0 + n0 == N0
+    lo1 = j0 == 0
+    hi1 = j0 + n1 == N1
+    pi = [ci, -1.0 - ci[lo0], 2.0 * N0 - 1.0 - ci[hi0], ci[lo1], ci[hi1]]
+    pj = [cj, cj[lo0], cj[hi0], -1.0 - cj[lo1], 2.0 * N1 - 1.0 - cj[hi1]]
+    pv = [x, -x[lo0], -x[hi0], -x[lo1], -x[hi1]]
+    for m0, g0 in ((lo0, -1.0 - ci), (hi0, 2.0 * N0 - 1.0 - ci)):
+        for m1, g1 in ((lo1, -1.0 - cj), (hi1, 2.0 * N1 - 1.0 - cj)):
+            corner = m0 & m1
+            pi.append(g0[corner])
+            pj.append(g1[corner])
+            pv.append(x[corner])
+    points = np.column_stack((np.concatenate(pi), np.concatenate(pj)))
+    ii, jj = np.indices((N0, N1))
+    phi = griddata(points, np.concatenate(pv), (ii, jj), method='cubic')
+
+    return phi
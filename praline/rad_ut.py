@@ -8,6 +8,7 @@ import math
 
 from constants import M_PROTON_G, ESU, C, V_PER_E
 
+from multiprocessing.pool import ThreadPool
 from scipy.fftpack import fftn, ifftn
 import numpy as np
 
@@ -51,20 +52,29 @@ def fnorm(fn):
     nrm = math.sqrt(buf.dot(buf))
     return nrm
 
+# Poisson kernels that have already been calculated, keyed by grid shape
+_kernels = {}
+
+def poisson_kernel(shape):
+    '''
+    Returns the Fourier space kernel of the Poisson equation for a grid shape.
+    Kernels are cached, so each grid shape is only calculated once per process.
+    '''
+    shape = tuple(shape)
+    if shape not in _kernels:
+        N0 = shape[0]
+        N1 = shape[1]
+        c0 = np.cos(2.0*math.pi*np.arange(N0)/N0)
+        c1 = np.cos(2.0*math.pi*np.arange(N1)/N0)
+        den = c0[:,np.newaxis] + c1[np.newaxis,:] - 2.0
+        den[0,0] = 1.0
+        q = 0.5 / den
+        q[0,0] = 0.0
+        _kernels[shape] = q
+    return _kernels[shape]
+
 def fconvolve(farr):
-    N0 = farr.shape[0]
-    N1 = farr.shape[1]
-    buf = np.zeros(farr.shape, dtype=complex)
-    for i0 in range(N0):
-        a0 = 2.0*math.pi*i0/N0
-        c0 = math.cos(a0)
-        for i1 in range(N1):
-            a1 = 2.0*math.pi*i1/N0
-            c1 = math.cos(a1)
-            if i0 != 0 or i1 != 0:
-                q = 0.5 / (c0 + c1 - 2.0)
-                buf[i0,i1] = farr[i0,i1] * q
-    return buf
+    return farr * poisson_kernel(farr.shape)
 
 def solve_poisson(src):
     buf = fftn(src)
@@ -72,10 +82,16 @@ def solve_poisson(src):
     buf = ifftn(buf)
     return buf.real
 
-def GS_Iteration(x, y, D, O, b):
+def GS_Iteration(x, y, D, O, b, omega=1.0, colour=None):
+    '''
+    One Gauss-Seidel sweep, over-relaxed by omega. If colour is 0 or 1 only
+    the red ((i+j) even) or black ((i+j) odd) points are updated.
+    '''
     for i in range(x.shape[0]):
-        for j in range(x.shape[1]):
-            x[i,j] = (b[i,j] - O(i,j,x,y)) / D(i,j,y)
+        start = 0 if colour is None else (i + colour) % 2
+        step = 1 if colour is None else 2
+        for j in range(start, x.shape[1], step):
+            x[i,j] = (1.0 - omega)*x[i,j] + omega*(b[i,j] - O(i,j,x,y)) / D(i,j,y)
 
 def residual(x, y, D, O, b):
     r = np.zeros(x.shape)
@@ -84,18 +100,173 @@ def residual(x, y, D, O, b):
             r[i,j] = O(i,j,x,y) + D(i,j,y)*x[i,j] - b[i,j]
     return r
 
-def Gauss_Seidel(x, y, D, O, b, maxiter=2000, tol=1.0E-02, talk=0):
+def _band_O(xp, coef, r0, r1):
+    # O for rows r0:r1 of x, held in the zero padded xp
+    d, cxp, cxm, cyp, cym = coef
+    o = cxp[r0:r1] * xp[r0+2:r1+2, 1:-1]
+    o += cxm[r0:r1] * xp[r0:r1, 1:-1]
+    o += cyp[r0:r1] * xp[r0+1:r1+1, 2:]
+    o += cym[r0:r1] * xp[r0+1:r1+1, :-2]
+    return o
+
+def _band_sweep(xp, coef, b, mask, omega, r0, r1):
+    # Updates the points of one colour in rows r0:r1. They only depend on
+    # points of the other colour, so bands can be updated concurrently.
+    xb = xp[r0+1:r1+1, 1:-1]
+    new = b[r0:r1] - _band_O(xp, coef, r0, r1)
+    new /= coef[0][r0:r1]
+    if omega != 1.0:
+        new *= omega
+        new += (1.0 - omega) * xb
+    np.copyto(xb, new, where=mask[r0:r1])
+
+def _band_residual(xp, coef, b, r, r0, r1):
+    r[r0:r1] = _band_O(xp, coef, r0, r1)
+    r[r0:r1] += coef[0][r0:r1] * xp[r0+1:r1+1, 1:-1]
+    r[r0:r1] -= b[r0:r1]
+
+class BandSweeper(object):
+    '''
+    Red/black Gauss-Seidel sweeps and residuals on the array form of D and O
+    (see algorithm.stencil). The grid is split into row bands that are updated
+    by a pool of threads; numpy releases the GIL for the array operations.
+    Results do not depend on the number of threads.
+    '''
+    def __init__(self, x, coef, b, threads=1):
+        N0 = x.shape[0]
+        self.xp = np.zeros((N0 + 2, x.shape[1] + 2))
+        self.xp[1:-1, 1:-1] = x
+        self.coef = coef
+        self.b = b
+        i, j = np.indices(x.shape)
+        self.masks = ((i + j) % 2 == 0, (i + j) % 2 == 1)
+        nbands = max(1, min(threads, N0))
+        edges = [N0 * k // nbands for k in range(nbands + 1)]
+        self.bands = list(zip(edges[:-1], edges[1:]))
+        self.pool = ThreadPool(threads) if threads > 1 else None
+
+    def _map(self, func):
+        if self.pool is None:
+            for band in self.bands:
+                func(band)
+        else:
+            self.pool.map(func, self.bands)
+
+    def sweep(self, omega=1.0, colour=None):
+        for c in ((0, 1) if colour is None else (colour,)):
+            mask = self.masks[c]
+            self._map(lambda band: _band_sweep(self.xp, self.coef, self.b, mask,
+                                               omega, band[0], band[1]))
+
+    def residual(self):
+        r = np.empty(self.b.shape)
+        self._map(lambda band: _band_residual(self.xp, self.coef, self.b, r,
+                                              band[0], band[1]))
+        return r
+
+    def x(self):
+        return self.xp[1:-1, 1:-1]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+def jacobi_radius(shape):
+    '''
+    Spectral radius of the Jacobi iteration of the Laplacian on a grid of this
+    shape with the boundary conditions of bc_enforce_D. This is the limit of
+    the exp(Lam)-weighted operator when the fluence contrast is small.
+    '''
+    return 0.5 * (math.cos(math.pi/shape[0]) + math.cos(math.pi/shape[1]))
+
+def sor_omega(rho):
+    '''
+    Optimal over-relaxation for a Jacobi spectral radius rho
+    '''
+    return 2.0 / (1.0 + math.sqrt(1.0 - rho**2))
+
+def Gauss_Seidel(x, y, D, O, b, maxiter=2000, tol=1.0E-02, talk=0,
+                 omega=1.0, chebyshev=False, nwarm=20, threads=0, stencil=None):
+    '''
+    Iterates x to the solution of O(x) + D*x = b.
+
+    omega is the over-relaxation of the sweeps (1.0 is plain Gauss-Seidel), or
+    'auto' to estimate the optimal omega. If chebyshev is True, red/black sweeps
+    with Chebyshev acceleration are used instead and omega is ignored. Both
+    estimates use the Jacobi spectral radius, which is the larger of the model
+    radius (jacobi_radius) and the one observed over nwarm plain sweeps.
+    If threads > 0, red/black sweeps of the array form of D and O returned
+    by stencil(y) are run on that many threads (see BandSweeper).
+    Returns the relative L2 norm of the residual and the last iteration number.
+    '''
+    if threads > 0:
+        bs = BandSweeper(x, stencil(y), b, threads)
+        sweep = bs.sweep
+        resid = bs.residual
+        xcur = bs.x
+    else:
+        sweep = lambda omega=1.0, colour=None: GS_Iteration(x, y, D, O, b, omega, colour)
+        resid = lambda: residual(x, y, D, O, b)
+        xcur = lambda: x
 
     L2b = fnorm(b)
-    for itn in range(maxiter):
-        xprev = x.copy()
-        GS_Iteration(x, y, D, O, b)
-        r = residual(x, y, D, O, b)
+    rho = None
+    itn0 = 0
+    if omega == 'auto' or chebyshev:
+        # Plain sweeps, converging at rho_GS = rho_J**2 once the error is smooth
+        rho = jacobi_radius(x.shape)
+        dx = []
+        for itn0 in range(min(nwarm, maxiter)):
+            xprev = xcur().copy()
+            sweep()
+            dx.append(fnorm(xcur() - xprev))
+        if len(dx) > 2 and dx[-3] > 0:
+            rho_gs = math.sqrt(dx[-1] / dx[-3])
+            rho = max(rho, math.sqrt(min(rho_gs, 1.0)))
+        rho = min(rho, 1.0 - 1.0E-06)
+        itn0 = len(dx)
+        if not chebyshev:
+            omega = sor_omega(rho)
+            print ("Estimated Jacobi spectral radius = %10.3E ; SOR omega = %6.4f" % (rho, omega))
+        else:
+            print ("Estimated Jacobi spectral radius = %10.3E ; Chebyshev acceleration" % rho)
+    elif omega != 1.0:
+        rho = jacobi_radius(x.shape)
+
+    w = 1.0
+    L2r = L2r0 = None
+    itn = max(itn0 - 1, 0)
+    for itn in range(itn0, maxiter):
+        if chebyshev:
+            # Chebyshev acceleration of the red/black half sweeps
+            for colour in (0, 1):
+                sweep(w, colour)
+                if w == 1.0:
+                    w = 1.0 / (1.0 - 0.5*rho**2)
+                else:
+                    w = 1.0 / (1.0 - 0.25*rho**2*w)
+        else:
+            sweep(omega)
+        r = resid()
         L2r = fnorm(r) / L2b
+        if L2r0 is None: L2r0 = L2r
         if talk > 0 and itn % talk == 0:
             print ("Iteration # %d, L2 of residual = %10.3E" % (itn, L2r))
         if L2r <= tol: break
 
+    if L2r is None:
+        L2r = fnorm(resid()) / L2b
+    elif rho is not None and 0 < L2r < L2r0:
+        # Plain Gauss-Seidel reduces the residual by rho_J**2 per sweep
+        nplain = itn0 + 1 + int(math.ceil(math.log(L2r / L2r0) / math.log(rho**2)))
+        print ("Estimated plain Gauss-Seidel iterations = %d ; iterations saved = %d"
+               % (nplain, nplain - (itn + 1)))
+
+    if threads > 0:
+        x[...] = bs.x()
+        bs.close()
+
     return (L2r, itn)
 
 def bc_enforce_D(x, i, j):
@@ -110,6 +281,12 @@ def bc_enforce_D(x, i, j):
     else:
         return x[i,j]
 
+def bc_enforce_Z(x, i, j):
+    if i < 0 or i >= x.shape[0] or j < 0 or j >= x.shape[1]:
+        return 0.0
+    else:
+        return x[i,j]
+
 def bc_enforce_N(x, i, j):
     ii, jj = i, j
     if i < 0: ii = 0
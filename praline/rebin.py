@@ -0,0 +1,83 @@
+'''
+Provides coarser binnings of a radiograph, made from the finest binning by block
+sums, so that several bin sizes can be explored without re-parsing the input
+'''
+import numpy as np
+
+
+def block_sum(array, factor):
+    '''
+    Sums factor x factor blocks of bins
+
+    Parameters
+    ----------
+    array (2D or 3D array): Per bin values, e.g. flux; a third axis is kept as is
+    factor (int): Number of bins per side of a block, must divide the number of
+                  bins per side so the coarse grid covers the same area
+
+    Returns
+    -------
+    coarse (2D or 3D array): The block sums
+    '''
+    if array.shape[0] % factor or array.shape[1] % factor:
+        raise ValueError("The rebinning factor %d does not divide the %dx%d bins "
+                         "of the radiograph" % (factor, array.shape[0], array.shape[1]))
+    n0 = array.shape[0] // factor
+    n1 = array.shape[1] // factor
+    blocks = array.reshape((n0, factor, n1, factor) + array.shape[2:])
+    return blocks.sum(axis=(1, 3))
+
+
+class RebinCache(object):
+    '''
+    Keeps the finest flux and flux_ref of a radiograph and returns them
+    rebinned by integer factors. Results are cached, and each factor is made
+    from the largest cached factor that divides it.
+
+    Parameters
+    ----------
+    flux (2D array): Number of protons per bin at the finest binning
+    flux_ref (2D array): Number protons per bin without an interaction region
+    bin_um (float): Length of the side of a finest bin, in microns
+    '''
+    def __init__(self, flux, flux_ref, bin_um):
+        self.bin_um = bin_um
+        self.shape = flux.shape
+        self.cache = {1: (flux, flux_ref)}
+
+    def check(self, factors):
+        '''
+        Raises ValueError unless every factor is a positive integer that divides
+        the number of bins per side
+        '''
+        bad = [f for f in factors
+               if f < 1 or self.shape[0] % f or self.shape[1] % f]
+        if bad:
+            raise ValueError("The rebinning factors %s do not divide the %dx%d bins "
+                             "of the radiograph" % (','.join(str(f) for f in bad),
+                                                    self.shape[0], self.shape[1]))
+
+    def get(self, factor):
+        '''
+        Returns the radiograph rebinned by factor
+
+        Parameters
+        ----------
+        factor (int): Number of finest bins per side of a coarse bin
+
+        Returns
+        -------
+        flux (2D array): Number of protons per bin
+        flux_ref (2D array): Number protons per bin without an interaction region
+        bin_um (float): Length of the side of a bin, in microns
+        '''
+        factor = int(factor)
+        self.check([factor])
+        if factor not in self.cache:
+            base = max(f for f in self.cache if factor % f == 0)
+            flux, flux_ref = self.cache[base]
+            f = factor // base
+            self.cache[factor] = (block_sum(flux, f), block_sum(flux_ref, f))
+
+        flux, flux_ref = self.cache[factor]
+        return flux, flux_ref, self.bin_um * factor
@@ -11,14 +11,44 @@ import rad_ut as ru
 import algorithm as alog
 import path
 import image
+import output
+import profiler
+import rebin
+import memo
 
 import numpy as np
 import argparse as ap
 
 
-def get_input_data():
+def omega_type(value):
+    '''
+    Parses the over-relaxation option, a float between 0 and 2 or 'auto'
+    '''
+    if value == 'auto':
+        return value
+    omega = float(value)
+    if not 0.0 < omega < 2.0:
+        raise ap.ArgumentTypeError("omega must be between 0 and 2, or 'auto'")
+    return omega
+
+
+def factors_type(value):
+    '''
+    Parses the rebinning factors option, e.g. 1,2,4
+    '''
+    factors = [int(f) for f in value.split(',') if f]
+    if not factors or min(factors) < 1:
+        raise ap.ArgumentTypeError("rebinning factors must be positive integers")
+    return factors
+
+
+def get_input_data(argv=None):
     '''
     Command line options and variables
+
+    Parameters
+    ----------
+    argv (list of strings): Arguments to parse, DEFAULT: sys.argv[1:]
     '''
     parser = ap.ArgumentParser(
         description="This script is used to reconstruct the magnetic field of Proton Radiography experiment")
@@ -30,7 +60,51 @@ def get_input_data():
                         help="The Gauss-Seidel tolerance. DEFAULT:1.0E-04")
     parser.add_argument("--iter", default=4000, type=int,
                         help="The number of Gauss-Seidel iterations. DEFAULT:4000")
-    args = parser.parse_args()
+    parser.add_argument("--omega", default=1.0, type=omega_type,
+                        help="Over-relaxation of the Gauss-Seidel sweeps (SOR), between 0 and 2, "
+                        "or 'auto' to estimate the optimal value. DEFAULT:1.0")
+    parser.add_argument("--chebyshev", action="store_true",
+                        help="Use Chebyshev accelerated red/black Gauss-Seidel sweeps")
+    parser.add_argument("--threads", default=0, type=int,
+                        help="Run red/black Gauss-Seidel sweeps on this many threads, "
+                        "0 uses the point by point sweeps. DEFAULT:0")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Solve directly on a quadtree of bins, merged where the fluence "
+                        "contrast is flat, instead of iterating on the uniform grid")
+    parser.add_argument("--adapt-tol", default=0.01, type=float,
+                        help="With --adaptive, the largest difference of the fluence contrast "
+                        "within a merged bin. DEFAULT:0.01")
+    parser.add_argument("--adapt-nsigma", default=2.0, type=float,
+                        help="With --adaptive, the number of standard deviations of the proton "
+                        "counting noise also allowed within a merged bin. DEFAULT:2.0")
+    parser.add_argument("--sweep", default=[1], type=factors_type,
+                        help="Comma separated factors to rebin the input by, e.g. 1,2,4. Each must "
+                        "divide the number of bins per side. The field is reconstructed at each "
+                        "bin size. DEFAULT:1")
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Directory to memoize Lam, Src and the initial and converged phi in, "
+                        "so later runs with other options resume from them")
+    parser.add_argument("--cache-size", default=32, type=int,
+                        help="Number of results kept in --cache-dir. DEFAULT:32")
+    parser.add_argument("--cache-mem", default=0, type=int,
+                        help="Number of results kept in memory for later jobs of the same "
+                        "lin-daemon worker. DEFAULT:0")
+    parser.add_argument("--output", default=None, type=str,
+                        help="Write BperpR, phi, Lam, flux and the run metadata to this .npz archive")
+    parser.add_argument("--float32", action="store_true",
+                        help="Store the output arrays as float32")
+    parser.add_argument("--no-compress", dest="compress", action="store_false",
+                        help="Store the output arrays uncompressed so they can be memory-mapped")
+    parser.add_argument("--profile", default=None, type=str,
+                        help="Write a JSON report of the time, memory and iterations of each stage to this file")
+    parser.add_argument("--cprofile", default=None, type=str,
+                        help="With --profile, also dump cProfile statistics of the solver to this file")
+    parser.add_argument("--socket", default=os.environ.get("PRALINE_SOCKET"), type=str,
+                        help="Submit the job to the lin-daemon listening on this UNIX socket. "
+                        "DEFAULT: $PRALINE_SOCKET")
+    args = parser.parse_args(argv)
+    if args.cprofile is not None and args.profile is None:
+        parser.error("--cprofile requires --profile")
 
     return args
 
@@ -73,17 +147,61 @@ def prad_wrap():
     bin_um(required): length of the bin in microns
     tol(option): The Gauss-Seidel tolerance
     iter(option): The number of Gauss-Seidel iterations
+    omega(option): Over-relaxation of the Gauss-Seidel sweeps, or 'auto'
+    chebyshev(option): Use Chebyshev accelerated red/black sweeps
+    threads(option): Number of threads for the red/black sweeps
+    adaptive(option): Solve on a quadtree of bins instead of the uniform grid
+    adapt-tol(option): Largest difference of the fluence contrast within a merged bin
+    adapt-nsigma(option): Counting noise allowed within a merged bin, in standard deviations
+    sweep(option): Factors to rebin the input by, reconstructing at each bin size
+    cache-dir(option): Directory to memoize the stages of the reconstruction in
+    cache-size(option): Number of results kept in the cache directory
+    cache-mem(option): Number of results kept in memory
+    output(option): .npz archive for the reconstructed arrays
+    float32(option): Store the output arrays as float32
+    no-compress(option): Store the output arrays uncompressed
+    profile(option): JSON report of the time, memory and iterations of each stage
+    cprofile(option): cProfile statistics of the solver
+    socket(option): Submit the job to the lin-daemon listening on this socket
 
     Returns
     -------
     files (string): png file that contains the reconstructed and/or path integrated
-                    magnetic field plot
+                    magnetic field plot, and optionally a .npz archive of the arrays
     '''
     # Input variables and options
     args = get_input_data()
+    if args.socket is not None:
+        import daemon
+        result = daemon.submit(args.socket, sys.argv[1:])
+        if result['status'] != 'done':
+            sys.exit(1)
+        return
+
+    run(args)
+
+
+def run(args):
+    '''
+    Runs the reconstruction and plotting for parsed command line options.
+    Used by prad_wrap and by the workers of lin-daemon.
+
+    Parameters
+    ----------
+    args (Namespace): Options returned by get_input_data
+
+    Returns
+    -------
+    meta (dict): Run metadata, including the residual and number of iterations.
+                 With several rebinning factors, meta['sweep'] holds the metadata
+                 of each bin size.
+    '''
     fn = args.input_file
     tol_iter = args.tol
     max_iter = args.iter
+    prof = profiler.Profiler(enabled=args.profile is not None, cprofile=args.cprofile)
+    # Stage results are kept for the life of the process, e.g. a lin-daemon worker
+    stages = memo.get_cache(args.cache_dir, args.cache_size, args.cache_mem)
 
 
     #############################
@@ -91,7 +209,9 @@ def prad_wrap():
     # Object for handling all the attributes of a proton radiography construction
     # problem. Typically, different proton radiograph formats are read into this
     # object for use with other reconstruction tools.
-    pr = pradreader.reader.loadPRRp(fn)
+    with prof.stage("load"):
+        pr = pradreader.reader.loadPRRp(fn)
+        prof.arrays(flux=pr.flux2D, flux_ref=pr.flux2D_ref)
     rtype = pr.rtype
     flux = pr.flux2D
     flux_ref = pr.flux2D_ref
@@ -102,15 +222,57 @@ def prad_wrap():
     flux = flux.T
     flux_ref = flux_ref.T
 
-    # Magnetic Field Alogrithm
-    print ("Calculating Magnetic Perpendicular Field...")
-    Bperp = np.zeros((flux.shape[0], flux.shape[0], 2))
+    # Coarser binnings are block sums of the input binning
+    binnings = rebin.RebinCache(flux, flux_ref, bin_um)
+    # Before any reconstruction, so a bad factor does not fail a long sweep
+    binnings.check(args.sweep)
+    sweep = []
+    for factor in args.sweep:
+        with prof.stage("rebin"):
+            flux_b, flux_ref_b, bin_b = binnings.get(factor)
+            prof.record(factor=factor, bin_um=bin_b)
+        # Each bin size of a sweep gets its own plot and output file
+        suffix = "" if args.sweep == [1] else " %gum" % bin_b
+
+        # Magnetic Field Alogrithm
+        print ("Calculating Magnetic Perpendicular Field..." + suffix)
+        Bperp = np.zeros((flux_b.shape[0], flux_b.shape[0], 2))
+
+        BperpR, BperpS, phi, Lam, GS = alog.B_recon(
+            flux_b, flux_ref_b, Bperp, s2d_cm, s2r_cm, bin_b, Ep_MeV, tol_iter, max_iter,
+            prof=prof, omega=args.omega, chebyshev=args.chebyshev, threads=args.threads,
+            cache=stages, adaptive=args.adaptive, adapt_tol=args.adapt_tol,
+            adapt_nsigma=args.adapt_nsigma)
+
+        #  Genereates the Log Reconstructed B perpendicular Projection,B_recon.png
+        with prof.stage("plot"):
+            plot.B_plot(BperpR, flux_ref_b, bin_b, rtype, "Reconstructed" + suffix)
+
+        meta = {'input_file': fn, 'rtype': rtype, 's2r_cm': s2r_cm,
+                's2d_cm': s2d_cm, 'Ep_MeV': Ep_MeV, 'bin_um': bin_b,
+                'num_bins': flux_b.shape[0], 'tol': tol_iter, 'iter': max_iter,
+                'omega': args.omega, 'chebyshev': args.chebyshev, 'threads': args.threads,
+                'adaptive': args.adaptive, 'adapt_tol': args.adapt_tol,
+                'adapt_nsigma': args.adapt_nsigma,
+                'residual': GS[0], 'iterations': GS[1]}
+        if args.output is not None:
+            fname = args.output
+            if suffix:
+                root, ext = os.path.splitext(args.output)
+                fname = "%s_%gum%s" % (root, bin_b, ext)
+            arrays = {'BperpR': BperpR, 'phi': phi, 'Lam': Lam,
+                      'flux': flux_b, 'flux_ref': flux_ref_b}
+            with prof.stage("output"):
+                output.save_output(fname, arrays, meta,
+                                   float32=args.float32, compress=args.compress)
+        sweep.append(meta)
+
+    meta = sweep[0] if len(sweep) == 1 else {'sweep': sweep}
 
-    BperpR, BperpS = alog.B_recon(
-        flux, flux_ref, Bperp, s2d_cm, s2r_cm, bin_um, Ep_MeV, tol_iter, max_iter)
+    if args.profile is not None:
+        prof.report(args.profile, meta)
 
-    #  Genereates the Log Reconstructed B perpendicular Projection,B_recon.png
-    plot.B_plot(BperpR, flux_ref, bin_um, rtype, "Reconstructed")
+    return meta
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+'''
+Provides the statistics reported by lin-analyze, computed in a single pass over
+blocks of rows so that memory-mapped images larger than RAM can be analyzed
+'''
+import math
+
+import numpy as np
+
+# Number of rows read at a time
+CHUNK_ROWS = 256
+
+# Percentiles reported for the flux and the fluence contrast
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+
+def contrast(flux, flux_ref):
+    '''
+    The fluence contrast, as calculated by algorithm.steady_state, of a block of bins
+
+    Parameters
+    ----------
+    flux (2D array): Number of protons per bin
+    flux_ref (2D array): Number protons per bin without an interaction region
+
+    Returns
+    -------
+    Lam (2D array): fluence contrast, zero where either flux is zero
+    '''
+    flux = np.asarray(flux, dtype=float)
+    flux_ref = np.asarray(flux_ref, dtype=float)
+    Lam = np.zeros(flux.shape)
+    ok = (flux != 0) & (flux_ref != 0)
+    np.divide(flux_ref, flux, out=Lam, where=ok)
+    np.sqrt(Lam, out=Lam)
+    Lam *= -2.0
+    Lam += 2.0
+    Lam[~ok] = 0.0
+    return Lam
+
+
+class ContrastRows(object):
+    '''
+    Row-sliceable view of the fluence contrast of an image, calculated only
+    for the rows that are read, e.g. a chunk at a time by output.save_output
+
+    Parameters
+    ----------
+    flux (2D array): Number of protons per bin, may be memory-mapped
+    flux_ref (2D array): Number protons per bin without an interaction region
+    '''
+    def __init__(self, flux, flux_ref):
+        self.flux = flux
+        self.flux_ref = flux_ref
+        self.shape = flux.shape
+        self.ndim = len(flux.shape)
+        self.dtype = np.dtype(float)
+
+    def __getitem__(self, rows):
+        return contrast(self.flux[rows], self.flux_ref[rows])
+
+
+class Moments(object):
+    '''
+    Running count, mean, variance, minimum and maximum of a stream of blocks.
+    Blocks are merged with the pairwise update of Chan et al., which stays
+    accurate for large counts.
+    '''
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values, where=None):
+        '''
+        Adds a block of values, optionally only those where the mask is True
+        '''
+        if where is not None:
+            # A copy the size of the block, reductions take where= only from numpy 1.17
+            values = values[where]
+        n = values.size
+        if n == 0:
+            return
+        mean = values.sum() / n
+        dev = values - mean
+        dev *= dev
+        m2 = dev.sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.n * n / total
+        self.n = total
+
+    def std(self):
+        '''
+        Standard deviation of the values, as np.std
+        '''
+        return math.sqrt(self.m2 / self.n) if self.n else float('nan')
+
+
+class StreamHist(object):
+    '''
+    Histogram with a fixed number of bins whose range grows to fit the values
+    added to it. When a value falls outside the range, the bin width is doubled
+    by merging neighbouring bins, so the data never need to be read twice.
+
+    Parameters
+    ----------
+    nbins (int): Number of bins, must be even
+    '''
+    def __init__(self, nbins=4096):
+        self.nbins = nbins
+        self.lo = None
+        self.width = None
+        self.counts = np.zeros(nbins)
+
+    def _grow(self, left):
+        merged = self.counts.reshape(-1, 2).sum(axis=1)
+        self.counts = np.zeros(self.nbins)
+        if left:
+            self.counts[self.nbins // 2:] = merged
+            self.lo -= self.nbins * self.width
+        else:
+            self.counts[:self.nbins // 2] = merged
+        self.width *= 2.0
+
+    def add(self, values, where=None):
+        '''
+        Adds a block of values, optionally only those where the mask is True
+        '''
+        if where is not None:
+            values = values[where]
+        if values.size == 0:
+            return
+        vmin = values.min()
+        vmax = values.max()
+        if self.lo is None:
+            span = (vmax - vmin) or max(abs(vmin), 1.0)
+            self.lo = vmin
+            self.width = span / (self.nbins - 1)
+        while vmin < self.lo:
+            self._grow(left=True)
+        while vmax >= self.lo + self.nbins * self.width:
+            self._grow(left=False)
+
+        idx = (values - self.lo) / self.width
+        idx = np.clip(idx, 0, self.nbins - 1).astype(int)
+        self.counts += np.bincount(idx.ravel(), minlength=self.nbins)
+
+    def edges(self):
+        '''
+        Returns the nbins + 1 bin edges
+        '''
+        if self.lo is None:
+            return np.zeros(self.nbins + 1)
+        return self.lo + self.width * np.arange(self.nbins + 1)
+
+    def percentile(self, q):
+        '''
+        Returns the q-th percentile, interpolated within a bin
+        '''
+        total = self.counts.sum()
+        if total == 0:
+            return float('nan')
+        cum = np.cumsum(self.counts)
+        target = q / 100.0 * total
+        k = int(np.searchsorted(cum, target))
+        k = min(k, self.nbins - 1)
+        below = cum[k - 1] if k > 0 else 0.0
+        frac = (target - below) / self.counts[k] if self.counts[k] else 0.0
+        return self.lo + self.width * (k + frac)
+
+
+def image_stats(flux, flux_ref=None, fluc=None, flux_min=10.0,
+                chunk_rows=CHUNK_ROWS, nbins=4096, percentiles=PERCENTILES):
+    '''
+    Calculates the flux and fluence contrast statistics of lin-analyze in one pass
+
+    Parameters
+    ----------
+    flux (2D array): Number of protons per bin, may be memory-mapped
+    flux_ref (2D array): Number protons per bin without an interaction region,
+                         used to calculate the fluence contrast if fluc is None
+    fluc (2D array): fluence contrast, may be memory-mapped
+    flux_min (float): The fluence contrast statistics only include bins with
+                      at least this many protons
+    chunk_rows (int): Number of rows read at a time
+    nbins (int): Number of bins of the histograms
+    percentiles (tuple): Percentiles to report
+
+    Returns
+    -------
+    stats (dict): for 'flux' and 'fluc', a dict of the mean, std, max, min,
+                  histogram counts and edges and percentiles. 'flux' also holds
+                  the number of bins with zero protons ('zero') and with flux_min
+                  or fewer protons ('low').
+    '''
+    fm, fh = Moments(), StreamHist(nbins)
+    lm, lh = Moments(), StreamHist(nbins)
+    zero = 0
+    low = 0
+    for row in range(0, flux.shape[0], chunk_rows):
+        fl = np.asarray(flux[row:row + chunk_rows], dtype=float)
+        if fluc is not None:
+            lc = np.asarray(fluc[row:row + chunk_rows], dtype=float)
+        else:
+            lc = contrast(fl, flux_ref[row:row + chunk_rows])
+
+        fm.add(fl)
+        fh.add(fl)
+        zero += fl.size - np.count_nonzero(fl > 0)
+        low += fl.size - np.count_nonzero(fl > flux_min)
+
+        counted = fl >= flux_min
+        lm.add(lc, where=counted)
+        lh.add(lc, where=counted)
+
+    result = {}
+    for name, m, h in (('flux', fm, fh), ('fluc', lm, lh)):
+        result[name] = {'mean': m.mean, 'std': m.std(), 'max': m.max, 'min': m.min,
+                        'count': m.n, 'hist': h.counts, 'edges': h.edges(),
+                        'percentiles': dict((q, h.percentile(q)) for q in percentiles)}
+    result['flux']['zero'] = zero
+    result['flux']['low'] = low
+
+    return result
@@ -5,6 +5,7 @@ setup(name='praline',
       packages=['praline'],
       entry_points={
           'console_scripts': ['lin-reconstruct = praline.reconstruct:prad_wrap',
-                              'lin-analyze = praline.analysis:prad_wrap'],
+                              'lin-analyze = praline.analysis:prad_wrap',
+                              'lin-daemon = praline.daemon:daemon_wrap'],
                 },
       )